@@ -2,15 +2,23 @@
 
 # global imports
 from pymongo import MongoClient
-from bs4 import BeautifulSoup
+from pymongo.errors import BulkWriteError
+from selectolax.lexbor import LexborHTMLParser
 from dateutil.tz import tzlocal
+from pybloom_live import ScalableBloomFilter
+import ahocorasick
 import traceback
-import requests
 import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.parse import urlsplit
+import asyncio
+import httpx
+import functools
 import datetime
+import mmap
+import multiprocessing
+import tempfile
 import os.path
-import fcntl  # for file-locking
-import errno
 import time
 import re
 import os
@@ -20,45 +28,69 @@ DB_PORT = 27017
 DB_NAME = "social"
 DB_COLLECTION = "urllist"
 
+# number of documents returned per round-trip when reading from mongodb
+MONGODB_BATCH_SIZE = 2000
+
+# maximum number of urls looked up in a single mongodb query
+MONGODB_LOOKUP_SIZE = 5000
+
+# mongodb error code of a duplicate key (an url that's already saved)
+MONGODB_DUPLICATE_KEY = 11000
+
 # timeout for web page requests (in seconds)
 REQUEST_TIMEOUT = 30
 
+# extension of the index files listing the urls saved to each output file
+INDEX_EXTENSION = ".idx"
 
-"""
-File locking (to prevent simultaneous reading and writing to the same file)
+# the crawled urls are kept in a bloom filter, which uses a fraction of the memory of a set
+# in exchange for skipping (about) 1 in every 1/CRAWLED_FILTER_ERROR_RATE new story urls
+# (the seed urls are checked exactly, see urls_crawled_in_dir())
+CRAWLED_FILTER_CAPACITY = 1000000
+CRAWLED_FILTER_ERROR_RATE = 0.001
 
-This is necessary because if two instances of the script are accidentally run,
- they might crawl duplicate data because one might be writing to the file at the same
- time the other is reading.
-"""
+# outermost <p> and <span> tags of a story page (lexbor filters out the nested ones)
+STORY_TEXT_SELECTOR = "p:not(p *, span *), span:not(p *, span *)"
 
+# number of results buffered before they're written to the output file
+WRITE_BATCH_SIZE = 64
 
-def wait_and_lock_file(file_handle):
-    """
-    Waits for the file to be unlocked, then acquire the lock
-    """
-    while True:
-        try:
-            fcntl.flock(file_handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
-            break
-        except IOError as e:
-            # raise on unrelated IOErrors
-            if e.errno != errno.EAGAIN:
-                raise
-            else:
-                print("waiting for file '{}' to be unlocked (it's already being used by another instance of this script)".format(file_handle.name))
-                time.sleep(1)
+# compressed response encodings to request (httpx decompresses them transparently).
+# brotli is usually the smallest for html, but httpx can only decode it with the brotli package
+try:
+    import brotli  # noqa: F401
+    ACCEPT_ENCODING = "gzip, br, deflate"
+except ImportError:
+    ACCEPT_ENCODING = "gzip, deflate"
+
+# default number of web page requests in flight (and pages parsed) at the same time
+MAX_CONCURRENT_REQUESTS = 20
 
 
-def unlock_file(file_handle):
+def create_client(workers):
     """
-    Release the lock
+    Create an async HTTP client that keeps connections alive and reuses them,
+    so repeated requests to the same publisher skip the TCP/TLS handshake.
+    The pool has a connection for each of the 'workers' requests in flight.
     """
-    fcntl.flock(file_handle, fcntl.LOCK_UN)
+    limits = httpx.Limits(max_connections=workers, max_keepalive_connections=workers)
+    transport = httpx.AsyncHTTPTransport(retries=2, http2=True, limits=limits)
+    return httpx.AsyncClient(
+        transport=transport,
+        timeout=REQUEST_TIMEOUT,
+        follow_redirects=True,
+        headers={"Accept-Encoding": ACCEPT_ENCODING},
+    )
 
 
-"""
-"""
+def positive_int(value):
+    """
+    Argument type for counts that must be at least 1
+    """
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("must be a positive integer, got '{}'".format(value))
+    return number
 
 
 def parse_args():
@@ -66,30 +98,36 @@ def parse_args():
     Parse the arguments from the command line
     """
     parser = argparse.ArgumentParser(description="Crawler for sentiment analysis")
-    parser.add_argument("directory", help=("firectory to save the file"))
-    parser.add_argument("filename", help=("file to write the output lines"))
+    parser.add_argument("directory", nargs="?", help=("firectory to save the file (not used with --output-collection)"))
+    parser.add_argument("filename", nargs="?", help=("file to write the output lines, each run writes its own '<filename>.<pid>.<timestamp>' shard (not used with --output-collection)"))
     parser.add_argument("--filter", dest="filter", help="filters for URLs. The script will only crawl from URLs containing these filters. If there's more than 1 filter, use a comma to separate them (ex: --filter 'politics, finance, ...')")
     parser.add_argument("--host", dest="host", help="mongodb host")
     parser.add_argument("--port", dest="port", help="mongodb port")
     parser.add_argument("--database", dest="database", help="mongodb database name to be used")
     parser.add_argument("--collection", dest="collection", help="mongodb collection to be used")
+    parser.add_argument("--output-collection", dest="output_collection", help="mongodb collection (in the same database) to save the results to, instead of writing them to files")
+    parser.add_argument("--workers", dest="workers", type=positive_int, help="number of pages to fetch and parse at the same time (default: {})".format(MAX_CONCURRENT_REQUESTS))
     args = vars(parser.parse_args())
     return args
 
 
 def get_urls_from_mongodb(host, port, database, collection):
-    client = MongoClient(host, port)
-    db = client[database]
-    col = db[collection]
+    """
+    Get the distinct urls stored in the 'url' arrays of the collection.
+    The arrays are flattened and deduplicated by the server, so only the urls are transferred.
+    """
+    pipeline = [
+        {"$unwind": "$url"},
+        {"$group": {"_id": "$url"}},
+    ]
 
-    documents = col.find()
+    with MongoClient(host, port) as client:
+        db = client[database]
+        col = db[collection]
 
-    urls = set()
+        documents = col.aggregate(pipeline, allowDiskUse=True, batchSize=MONGODB_BATCH_SIZE)
 
-    for document in documents:
-        url_list = document["url"]
-        for url in url_list:
-            urls.add(url)
+        urls = set(document["_id"] for document in documents)
 
     return urls
 
@@ -97,35 +135,82 @@ def get_urls_from_mongodb(host, port, database, collection):
 def urls_crawled_in_file(file_path):
     """
     Read existing lines and get the urls already saved to avoid duplicates.
+    The file is memory-mapped and only the url field of each line is decoded.
     """
-    lines = []
-
     urls_crawled = set()
 
-    try:
-        if os.path.isfile(file_path):
-            with open(file_path, "r") as file_input:
-                lines = file_input.readlines()
-            lines = [x.strip() for x in lines]  # remove whitespace and newline characters
-
-        for line in lines:
-            values = line.split("^")
-            if len(values) != 8:
-                raise Exception("Invalid line format")
-            twitter_id = values[4]
-            urls_crawled.add(twitter_id)
-    except Exception as e:
-        pass
+    if os.path.getsize(file_path) > 0:
+        with open(file_path, "rb") as file_input, \
+                mmap.mmap(file_input.fileno(), 0, access=mmap.ACCESS_READ) as file_map:
+            for line in iter(file_map.readline, b""):
+                # the text (last field) may contain stray separators, the other fields can't
+                if line.count(b"^") < 7:
+                    continue  # skip invalid lines
+                twitter_id = line.split(b"^", 5)[4]
+                urls_crawled.add(twitter_id.decode("utf-8", "replace"))
 
     return urls_crawled
 
 
-def urls_crawled_in_dir(dir_path):
-    files = [f for f in os.listdir(dir_path) if os.path.isfile(os.path.join(dir_path, f))]
+def urls_crawled_in_index(index_path):
+    """
+    Iterate over the urls listed in an index file (one url per line).
+    The file is read line by line, so large (merged) indexes are never fully in memory.
+    """
+    with open(index_path, "r", encoding="utf-8") as index_input:
+        for line in index_input:
+            yield line.rstrip("\n")
 
-    urls_crawled = set()
+
+def write_index(index_path, urls):
+    """
+    Write an index file listing the given urls (one url per line).
+    The index is written to a temporary file first, so it's either complete or missing.
+    """
+    # the temporary file also ends with the index extension, so it's never mistaken for an output file
+    with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=os.path.dirname(index_path), suffix=INDEX_EXTENSION, delete=False) as index_output:
+        index_output.writelines(url + "\n" for url in urls)
+    os.replace(index_output.name, index_path)
+
+
+def urls_crawled_in_dir(dir_path, urls_to_crawl):
+    """
+    Get a (bloom) filter of the urls already saved to the output files in the directory.
+    They are read from each file's index, which is built from the file itself
+    the first time (for files written before indexes existed).
+    The saved urls are also removed from 'urls_to_crawl' (the seed urls) while they're read.
+    This check is exact: a false positive of the filter would skip a seed page, and every story
+    linked from it, on every run (the filter's hashing is the same across runs).
+    """
+    files = [f for f in os.listdir(dir_path) if os.path.isfile(os.path.join(dir_path, f)) and not f.endswith(INDEX_EXTENSION)]
+
+    urls_crawled = ScalableBloomFilter(initial_capacity=CRAWLED_FILTER_CAPACITY, error_rate=CRAWLED_FILTER_ERROR_RATE)
     for file in files:
-        urls_crawled.update(urls_crawled_in_file(os.path.join(dir_path, file)))
+        file_path = os.path.join(dir_path, file)
+        index_path = file_path + INDEX_EXTENSION
+        if not os.path.isfile(index_path):
+            try:
+                urls = urls_crawled_in_file(file_path)
+            except FileNotFoundError:
+                continue  # an empty shard, removed by the instance that wrote it
+            except Exception as e:
+                # don't cache a partial index, the file is scanned again next time
+                print("error reading {} - {}".format(file_path, str(e)))
+                traceback.print_exc()
+                continue
+            # files without any output line (not written by the crawler) don't get an index
+            if len(urls) > 0:
+                write_index(index_path, urls)
+            for url in urls:
+                urls_crawled.add(url)
+                urls_to_crawl.discard(url)
+            continue
+        try:
+            for url in urls_crawled_in_index(index_path):
+                urls_crawled.add(url)
+                urls_to_crawl.discard(url)
+        except FileNotFoundError:
+            pass  # an empty shard, removed (with its index) by the instance that wrote it
 
     return urls_crawled
 
@@ -139,64 +224,115 @@ def current_date_for_timestamp():
     return now.strftime('%a %b %d %H:%M:%S %Z %Y')
 
 
-def save_result(file_handle, result):
+def encode_result(result, date_of_tweet):
     """
-    Write a result (dictionary with the results from a story) to the file.
+    Encode a result (dictionary with the results from a story) as an output line.
     """
     location_long = "locationLong"
     location_lat = "locationLat"
     verbose_location = "spider"
     user_name = "userName"
     screen_name = "screenName"
-    date_of_tweet = current_date_for_timestamp()
 
     twitter_id = result["url"]
 
     tweeted_text = "<title>{}</title><body>{}</body>".format(result["title"], result["body"])
 
-    file_handle.write("{}^{}^{}^{}^{}^{}^{}^{}\n".format(
-                        location_long,
-                        location_lat,
-                        verbose_location,
-                        date_of_tweet,
-                        twitter_id,
-                        user_name,
-                        screen_name,
-                        tweeted_text
-                        ))
+    line = "^".join((
+                location_long,
+                location_lat,
+                verbose_location,
+                date_of_tweet,
+                twitter_id,
+                user_name,
+                screen_name,
+                tweeted_text
+                ))
+    return line.encode("utf-8", "replace") + b"\n"
 
 
-def crawl(url):
+def save_results(file_handle, index_handle, results):
     """
-    Extract the data (text inside <p> and <span> tags) from a news story page.
+    Write a batch of results to the (binary) file with a single write call,
+    and their urls to the file's index.
+    All the results in the batch share the same timestamp.
+    """
+    date_of_tweet = current_date_for_timestamp()
+    file_handle.write(b"".join(encode_result(result, date_of_tweet) for result in results))
+    # the lines must reach the file before their urls reach the index,
+    # otherwise a killed run could leave urls in the index that were never saved
+    file_handle.flush()
+    index_handle.write(b"".join(result["url"].encode("utf-8") + b"\n" for result in results))
+    index_handle.flush()
+
+
+def parse_story(url, content):
+    """
+    Extract the data (text inside <p> and <span> tags) from the content of a news story page.
     Returns a dictionary with 'url', 'title', and 'body' as keys.
+    Runs in a worker process, so it only takes and returns plain (cheap to pickle) values.
     """
-    result = None
+    tree = LexborHTMLParser(content)
+    title = tree.css_first("title").text()
+
+    # the full text of the outermost <p>/<span> nodes (including inline markup like <b> or <em>),
+    # nested ones are already part of it
+    paragraphs = (p.text(separator=" ", strip=True) for p in tree.css(STORY_TEXT_SELECTOR))
+    text = " ".join(p for p in paragraphs if p != "")
+
+    text = text.replace("^", "")  # needed to not conflict with the field separator
+
+    result = {}
+    result["url"] = url
+    result["title"] = title
+    result["body"] = text
+    return result
+
+
+def insert_results(col, results):
+    """
+    Insert a batch of results into the output collection with a single bulk write.
+    All the results in the batch share the same timestamp.
+    Results whose url is already saved (by another instance) are skipped.
+    """
+    date = datetime.datetime.now(tzlocal())
+    documents = [dict(result, date=date) for result in results]
     try:
-        response = requests.get(url, timeout=REQUEST_TIMEOUT)
-        response.raise_for_status()
-        content = response.text
+        col.insert_many(documents, ordered=False)
+    except BulkWriteError as e:
+        if e.details.get("writeConcernErrors") or \
+                any(error["code"] != MONGODB_DUPLICATE_KEY for error in e.details["writeErrors"]):
+            raise
 
-        soup = BeautifulSoup(content, 'html.parser')
-        title = soup.title.string
-        body = soup.body
 
-        text = ""
+def urls_saved_in_collection(col, urls):
+    """
+    Get which of the urls are already saved in the output collection.
+    They are looked up in chunks so each query stays well under mongodb's document size limit.
+    """
+    urls = list(urls)
 
-        paragraphs = body.find_all("p", text=True)
-        for p in paragraphs:
-            text = text + p.string.strip() + " "
+    urls_saved = set()
+    for i in range(0, len(urls), MONGODB_LOOKUP_SIZE):
+        documents = col.find({"url": {"$in": urls[i:i + MONGODB_LOOKUP_SIZE]}}, projection={"url": 1, "_id": 0})
+        urls_saved.update(document["url"] for document in documents)
 
-        paragraphs = body.find_all("span", text=True)
-        for p in paragraphs:
-            text = text + p.string.strip() + " "
+    return urls_saved
 
-        text = text.replace("^", "")  # needed to not conflict with the field separator
 
-        result = {}
-        result["url"] = url
-        result["title"] = title
-        result["body"] = text
+async def crawl(client, semaphore, process_pool, url):
+    """
+    Fetch a news story page and parse it in the process pool.
+    Returns the dictionary from parse_story(), or None if the page couldn't be crawled.
+    """
+    result = None
+    try:
+        async with semaphore:
+            response = await client.get(url)
+        response.raise_for_status()
+        content = response.text
+
+        result = await asyncio.get_running_loop().run_in_executor(process_pool, parse_story, url, content)
     except Exception as e:
         print("error in {} - {}".format(url, str(e)))
         traceback.print_exc()
@@ -204,7 +340,31 @@ def crawl(url):
     return result
 
 
-def get_links(url, filter_list):
+@functools.lru_cache(maxsize=256)
+def story_pattern(last_publisher):
+    """
+    Compiled pattern matching the story urls of a publisher.
+    """
+    return re.compile(r"^https?://.*{}[\.\w\-]*/.+/?$".format(re.escape(last_publisher)))
+
+
+def create_filter_automaton(filter_list):
+    """
+    Build an Aho-Corasick automaton that finds any of the filters in a single pass over a url.
+    Returns None when every url passes the filters.
+    """
+    # an empty filter is contained in every url
+    if len(filter_list) == 0 or "" in filter_list:
+        return None
+
+    automaton = ahocorasick.Automaton()
+    for f in filter_list:
+        automaton.add_word(f, f)
+    automaton.make_automaton()
+    return automaton
+
+
+async def get_links(client, semaphore, url, filter_automaton):
     """
     Extract individual story urls to be crawled.
     This is usually called to extract links from a main page or sub-page url.
@@ -212,35 +372,28 @@ def get_links(url, filter_list):
     links = []
 
     try:
-        url_publisher = re.search("^(http|https)://(.*)\..{2,20}.*$", url).group(2)
-        if url_publisher.strip() != "":
-            publishers = url_publisher.split(".")
-            publishers = [p.lower() for p in publishers]
+        host = urlsplit(url).hostname or ""
+        # the publisher names are the host labels without the top-level domain
+        publishers = host.split(".")[:-1]
+        if len(publishers) > 0:
             last_publisher = publishers[-1]
 
-            pattern_story = re.compile("^(http|https)://.*{}[\.\w\-]*/.+/?$".format(last_publisher))
+            pattern_story = story_pattern(last_publisher)
 
-            response = requests.get(url, timeout=REQUEST_TIMEOUT)
+            async with semaphore:
+                response = await client.get(url)
             response.raise_for_status()
             content = response.text
 
-            soup = BeautifulSoup(content, 'html.parser')
-            body = soup.body
-            for a in body.find_all('a', href=True):
-                link = a.get("href").lower()
+            tree = await asyncio.to_thread(LexborHTMLParser, content)
+            # story links always contain the publisher's name, so let lexbor skip the other links
+            for a in tree.css('a[href*="{}" i]'.format(last_publisher)):
+                link = (a.attributes["href"] or "").lower()
+                # the query and the story pattern both require the publisher's name in the link,
+                # which also covers the check that it contains one of the publisher names
                 if pattern_story.match(link):
-                    proceed = False
-                    for publisher in publishers:
-                        if publisher in link:
-                            proceed = True
-                    if proceed is True:
-                        if len(filter_list) > 0:
-                            proceed = False
-                            for f in filter_list:
-                                if f in link:
-                                    proceed = True
-                        if proceed is True:
-                            links.append(link)
+                    if filter_automaton is None or next(filter_automaton.iter(link), None) is not None:
+                        links.append(link)
 
     except Exception as e:
         print("error in {} - {}".format(url, str(e)))
@@ -248,6 +401,63 @@ def get_links(url, filter_list):
     return links
 
 
+async def run(save, output_col, urls_to_crawl, urls_crawled, filter_automaton, workers):
+    """
+    Crawl the stories linked from every url not crawled yet.
+    Up to 'workers' pages are fetched concurrently, the pages with links are parsed on
+    a pool of as many threads, the stories on a pool of processes (one per cpu),
+    and the results are passed to save() in batches as soon as they're ready.
+    With an output collection, links already saved in it are skipped as well.
+    """
+    semaphore = asyncio.Semaphore(workers)
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=workers))
+
+    # the workers must not be forked from this (multithreaded) process, that can deadlock them
+    with ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context("forkserver")) as process_pool:
+        async with create_client(workers) as client:
+            # every task puts itself in this queue when it's done, so index pages and stories
+            # are handled as soon as they finish, and dropped once they've been handled
+            done = asyncio.Queue()
+            pages = set()
+            stories = set()
+
+            def start(coroutine, tasks):
+                task = asyncio.ensure_future(coroutine)
+                task.add_done_callback(done.put_nowait)
+                tasks.add(task)
+
+            for url in urls_to_crawl:
+                start(get_links(client, semaphore, url, filter_automaton), pages)
+
+            results = []
+            try:
+                while len(pages) > 0 or len(stories) > 0:
+                    task = await done.get()
+                    if task in pages:
+                        pages.remove(task)
+                        links = task.result()
+                        if output_col is not None and len(links) > 0:
+                            urls_saved = await asyncio.to_thread(urls_saved_in_collection, output_col, links)
+                            links = [link for link in links if link not in urls_saved]
+                        for link in links:
+                            if link not in urls_crawled:
+                                urls_crawled.add(link)
+                                start(crawl(client, semaphore, process_pool, link), stories)
+                    else:
+                        stories.remove(task)
+                        result = task.result()
+                        if result is not None:
+                            results.append(result)
+                        if len(results) >= WRITE_BATCH_SIZE:
+                            # saving blocks (on the disk or mongodb), keep it off the event loop
+                            await asyncio.to_thread(save, results)
+                            results = []
+            finally:
+                # also save what's been crawled so far if the crawl is interrupted
+                if len(results) > 0:
+                    await asyncio.to_thread(save, results)
+
+
 def main():
     # argument parsing
     args = parse_args()
@@ -255,6 +465,7 @@ def main():
     port = args["port"]
     database = args["database"]
     collection = args["collection"]
+    workers = args["workers"]
 
     if host is None:
         host = DB_HOST
@@ -264,6 +475,8 @@ def main():
         database = DB_NAME
     if collection is None:
         collection = DB_COLLECTION
+    if workers is None:
+        workers = MAX_CONCURRENT_REQUESTS
 
     filters = args["filter"]
 
@@ -271,33 +484,58 @@ def main():
     if filters is not None:
         filter_list = filters.split(",")
         filter_list = [f.strip() for f in filter_list]
+    filter_automaton = create_filter_automaton(filter_list)
 
     directory = args["directory"]
     filename = args["filename"]
+    output_collection = args["output_collection"]
+
+    if output_collection is not None:
+        with MongoClient(host, port) as client:
+            output_col = client[database][output_collection]
+            output_col.create_index("url", unique=True)
+
+            # the saved urls are looked up in the collection, this only holds the ones crawled in this run
+            urls_crawled = set()
+
+            urls_to_crawl = get_urls_from_mongodb(host, port, database, collection)
+            urls_to_crawl.difference_update(urls_saved_in_collection(output_col, urls_to_crawl))
+
+            save = functools.partial(insert_results, output_col)
+            asyncio.run(run(save, output_col, urls_to_crawl, urls_crawled, filter_automaton, workers))
+        return
+
+    if directory is None or filename is None:
+        raise Exception("The directory and filename are required (unless --output-collection is used)")
 
     # check if directory exists, and if not, exit
     if not os.path.isdir(directory):
         raise Exception("The directory '{}' does not exist".format(directory))
 
-    # generate full file path (directory + filename)
-    file_path = os.path.join(directory, filename)
-
-    urls_crawled = urls_crawled_in_dir(directory)
+    # generate full file path (directory + filename + shard suffix)
+    # every run writes to its own file, so instances never write to the same file
+    # and don't need to lock it (merge.py joins the shards afterwards)
+    file_path = os.path.join(directory, "{}.{}.{}".format(filename, os.getpid(), int(time.time())))
 
     urls_to_crawl = get_urls_from_mongodb(host, port, database, collection)
 
-    with open(file_path, "a") as file_output:
-        wait_and_lock_file(file_output)
-        for url in urls_to_crawl:
-            if url not in urls_crawled:
-                links = get_links(url, filter_list)
-                for link in links:
-                    if link not in urls_crawled:
-                        result = crawl(link)
-                        if result is not None:
-                            save_result(file_output, result)
-                        urls_crawled.add(link)
-        unlock_file(file_output)
+    urls_crawled = urls_crawled_in_dir(directory, urls_to_crawl)
+
+    try:
+        with open(file_path, "ab") as file_output, \
+                open(file_path + INDEX_EXTENSION, "ab") as index_output:
+            try:
+                save = functools.partial(save_results, file_output, index_output)
+                asyncio.run(run(save, None, urls_to_crawl, urls_crawled, filter_automaton, workers))
+            finally:
+                # flush the file before its index so the index never lists a missing line
+                file_output.flush()
+                index_output.flush()
+    finally:
+        # don't leave empty shards behind when nothing new was crawled (or the crawl failed)
+        if os.path.getsize(file_path) == 0:
+            os.remove(file_path)
+            os.remove(file_path + INDEX_EXTENSION)
 
 
 if __name__ == "__main__":
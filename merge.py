@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+# global imports
+import argparse
+import shutil
+import re
+import os
+
+# extension of the index files written by the crawler (see INDEX_EXTENSION in crawler.py)
+INDEX_EXTENSION = ".idx"
+
+
+def parse_args():
+    """
+    Parse the arguments from the command line
+    """
+    parser = argparse.ArgumentParser(description="Merge the output shards written by the crawler into a single file. Don't run it while a crawler is writing to the directory.")
+    parser.add_argument("directory", help=("directory with the shards"))
+    parser.add_argument("filename", help=("filename given to the crawler (the shards are named '<filename>.<pid>.<timestamp>')"))
+    parser.add_argument("output", help=("file to append the merged lines to"))
+    parser.add_argument("--remove", dest="remove", action="store_true", help="remove the shards (and their indexes) once they're merged")
+    args = vars(parser.parse_args())
+    return args
+
+
+def shards_in_dir(dir_path, filename):
+    """
+    Get the paths of the shards of a filename, oldest first.
+    """
+    pattern_shard = re.compile(r"^{}\.\d+\.(\d+)$".format(re.escape(filename)))
+
+    shards = []
+    for f in os.listdir(dir_path):
+        match = pattern_shard.match(f)
+        if match is not None and os.path.isfile(os.path.join(dir_path, f)):
+            shards.append((int(match.group(1)), os.path.join(dir_path, f)))
+
+    return [path for timestamp, path in sorted(shards)]
+
+
+def append_file(source_path, file_handle):
+    """
+    Append the content of a file to an open (binary) file.
+    """
+    with open(source_path, "rb") as file_input:
+        shutil.copyfileobj(file_input, file_handle)
+
+
+def main():
+    args = parse_args()
+    directory = args["directory"]
+    filename = args["filename"]
+    output_path = args["output"]
+    index_path = output_path + INDEX_EXTENSION
+
+    # check if directory exists, and if not, exit
+    if not os.path.isdir(directory):
+        raise Exception("The directory '{}' does not exist".format(directory))
+
+    shards = shards_in_dir(directory, filename)
+
+    # the indexes are merged too when they list every line of the output,
+    # otherwise the output's index is removed and the crawler rebuilds it the next time it runs
+    merge_indexes = (not os.path.isfile(output_path) or os.path.isfile(index_path)) and \
+        all(os.path.isfile(shard + INDEX_EXTENSION) for shard in shards)
+
+    with open(output_path, "ab") as file_output:
+        for shard in shards:
+            append_file(shard, file_output)
+
+    if merge_indexes:
+        with open(index_path, "ab") as index_output:
+            for shard in shards:
+                append_file(shard + INDEX_EXTENSION, index_output)
+    elif os.path.isfile(index_path):
+        os.remove(index_path)
+
+    if args["remove"]:
+        for shard in shards:
+            os.remove(shard)
+            if os.path.isfile(shard + INDEX_EXTENSION):
+                os.remove(shard + INDEX_EXTENSION)
+
+    print("merged {} shard(s) into '{}'".format(len(shards), output_path))
+
+
+if __name__ == "__main__":
+    main()